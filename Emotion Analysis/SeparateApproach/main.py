@@ -1,44 +1,127 @@
 import os
-import json
+import msgspec
+import asyncio
 import logging
+import logging.handlers
+import httpx
 from pathlib import Path
-from typing import Dict, Optional
-from openai import OpenAI
+from typing import Callable, Dict, List, Optional, Type, Union
+from openai import AsyncOpenAI
+from diskcache import Cache
 from dotenv import load_dotenv
 from datetime import datetime
+import argparse
+from common import (
+    Adorescore, AnalysisResult, Emotion, Emotions, ResultT, Score, Topics,
+    get_cached, prompt_hasher, read_input_folder, read_prompt, save_result
+)
+
+# Upper bound on files analyzed at once, keeps us inside the Gemini RPM limit
+MAX_CONCURRENT_FILES = 50
+
+# Log level used when LOG_LEVEL is not set in the environment
+DEFAULT_LOG_LEVEL = "WARNING"
+
+# One log file per process, named when the module is first imported
+LOG_TIMESTAMP = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+# Log records are buffered and written to file in blocks of this size
+LOG_BUFFER_CAPACITY = 1024
+
+# Connection pool shared by all requests from one analyzer
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+
+# Rate-limited, timed out and 5xx requests are retried this many times,
+# with exponential backoff that honors the Retry-After header
+MAX_RETRIES = 6
+
+# Cached API responses expire after a day
+CACHE_EXPIRE_SECONDS = 86400
+
+COMBINED_PROMPT_HEADER = (
+    "You are a Customer Emotion Analysis System expert. Perform all of the "
+    "analyses below on the provided customer feedback text in a single pass. "
+    "The input is the raw feedback text; for the Adorescore section, use the "
+    "topics from your own Topic Analysis. Do not return the intermediate "
+    "results. Respond only with the single JSON object described in the "
+    "Output Format section."
+)
+
+# Per-step response schemas, validated when each response is decoded
+class EmotionDetection(msgspec.Struct):
+    primary_emotion: Emotion
+    secondary_emotion: Optional[Emotion] = None
+
+class TopicAnalysis(msgspec.Struct):
+    main_topics: List[str]
+    subtopics: Dict[str, List[str]] = {}
+
+class TopicScore(msgspec.Struct):
+    score: Score
+
+class AdorescoreAnalysis(msgspec.Struct):
+    overall_adorescore: Score
+    topic_adorescores: Dict[str, TopicScore] = {}
+
+def _prompt_instructions(template: str) -> str:
+    """Return only the instructions of a prompt template.
+
+    The role description, the per-step output format and the closing line are
+    dropped so the template can be embedded in the combined prompt.
+    """
+    start = template.find("Instructions:")
+    end = min(
+        (i for i in (template.find("Output Format:"), template.find("```")) if i != -1),
+        default=len(template)
+    )
+    return template[max(start, 0):end].strip()
+
+def _prompt_example(template: str) -> str:
+    """Return the JSON example block of a prompt template."""
+    start = template.find("```json")
+    end = template.find("```", start + len("```json"))
+    return template[start:end + len("```")].strip()
 
 class SeparateEmotionAnalyzer:
     def __init__(self):
         load_dotenv()
-        self.client = OpenAI(
+        self.client = AsyncOpenAI(
             api_key=os.getenv("GEMINI_API_KEY"),
-            base_url="https://generativelanguage.googleapis.com/v1beta/openai/"
+            base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
+            http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS),
+            max_retries=MAX_RETRIES
         )
         self.logger = self._setup_logger()
+        self.cache = Cache(Path(__file__).parent / ".llm_cache")
         self.prompts = self._load_prompts()
 
     def _setup_logger(self) -> logging.Logger:
         """Setup logging configuration."""
+        logger = logging.getLogger("separate_analyzer")
+
+        # Handlers are attached once per process, later analyzers reuse them
+        if logger.handlers:
+            return logger
+
         log_dir = Path(__file__).parent / "logs"
         log_dir.mkdir(parents=True, exist_ok=True)
+        log_file = log_dir / f"emotion_analysis_{LOG_TIMESTAMP}.log"
 
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        log_file = log_dir / f"emotion_analysis_{timestamp}.log"
-
-        logger = logging.getLogger("separate_analyzer")
-        logger.setLevel(logging.INFO)
+        logger.setLevel(os.getenv("LOG_LEVEL", DEFAULT_LOG_LEVEL).upper())
 
         file_handler = logging.FileHandler(log_file)
-        file_handler.setLevel(logging.INFO)
-
         console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
 
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         file_handler.setFormatter(formatter)
         console_handler.setFormatter(formatter)
 
-        logger.addHandler(file_handler)
+        # Buffer file writes, flushing early only when an error is logged
+        buffered_handler = logging.handlers.MemoryHandler(
+            LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR, target=file_handler
+        )
+
+        logger.addHandler(buffered_handler)
         logger.addHandler(console_handler)
 
         return logger
@@ -56,146 +139,226 @@ class SeparateEmotionAnalyzer:
         for key, filename in prompt_files.items():
             path = Path(__file__).parent / "prompts" / filename
             try:
-                with open(path, "r", encoding="utf-8") as f:
-                    prompts[key] = f.read()
-                    self.logger.info(f"Loaded {key} prompt from {path}")
+                prompts[key] = read_prompt(path)
+                self.logger.debug(f"Loaded {key} prompt from {path}")
             except FileNotFoundError:
                 self.logger.error(f"Prompt file not found: {path}")
                 raise FileNotFoundError(f"Prompt file not found: {path}")
 
+        # Fuse the analysis templates into one prompt so a document can be
+        # analyzed with a single call instead of the prompt chain. The output
+        # template is only used here, to describe the combined format.
+        prompts['combined'] = "\n\n".join([
+            COMBINED_PROMPT_HEADER,
+            "### Emotion Detection\n" + _prompt_instructions(prompts['emotion']),
+            "### Topic Analysis\n" + _prompt_instructions(prompts['topic']),
+            "### Adorescore\n" + _prompt_instructions(prompts['adorescore']),
+            "### Output Format\n" + _prompt_example(prompts['output']),
+            "Your response must be a valid JSON object as specified above. Do not "
+            "include any additional text, explanations, or markdown formatting."
+        ])
+
         return prompts
 
-    def _call_api(self, prompt: str, text: str) -> Optional[Dict]:
-        """Make an API call to Gemini."""
+    def _cache_key(self, prompt: str, text: Union[str, bytes]) -> str:
+        """Build the response cache key for a prompt and input text."""
+        if isinstance(text, str):
+            text = text.encode("utf-8")
+        hasher = prompt_hasher(prompt).copy()
+        hasher.update(text)
+        return hasher.hexdigest()
+
+    async def _call_api(self, prompt: str, text: Union[str, bytes],
+                        schema: Type[ResultT]) -> Optional[ResultT]:
+        """Make an API call to Gemini, reusing cached responses.
+
+        The response is decoded and validated against ``schema``. ``text`` may
+        be pre-serialized JSON bytes, which are hashed as-is and only decoded
+        when the request is actually sent.
+        """
+        key = self._cache_key(prompt, text)
+        cached = get_cached(self.cache, key, schema, self.logger)
+        if cached is not None:
+            self.logger.debug("Using cached Gemini response")
+            return cached
+
+        content = text.decode("utf-8") if isinstance(text, bytes) else text
+
         try:
-            self.logger.info("Sending request to Gemini API")
-            response = self.client.chat.completions.create(
+            self.logger.debug("Sending request to Gemini API")
+            response = await self.client.chat.completions.create(
                 model="gemini-2.0-flash",
                 n=1,
+                # Only the user message may vary between calls, keep the
+                # system prompt static so Gemini can reuse its cached prefix
                 messages=[
                     {"role": "system", "content": prompt},
-                    {"role": "user", "content": text}
-                ]
+                    {"role": "user", "content": content}
+                ],
+                # JSON mode returns bare JSON, without markdown code fences
+                response_format={"type": "json_object"}
             )
             
             result = response.choices[0].message.content
-            self.logger.info("Received response from Gemini API")
-            
-            # Clean up the response
-            result = result.replace('```json', '').replace('```', '').strip()
+            self.logger.debug("Received response from Gemini API")
             
             try:
-                return json.loads(result)
-            except json.JSONDecodeError:
-                self.logger.error(f"Error parsing JSON response: {result}")
+                parsed_result = msgspec.json.decode(result, type=schema)
+            except msgspec.DecodeError as e:
+                self.logger.error(f"Error parsing JSON response ({e}): {result}")
                 return None
                 
         except Exception as e:
             self.logger.error(f"Error calling Gemini API: {e}")
             return None
 
-    def analyze_emotions(self, text: str) -> Optional[Dict]:
+        self.cache.set(key, result, expire=CACHE_EXPIRE_SECONDS)
+        return parsed_result
+
+    async def analyze_emotions(self, text: str) -> Optional[EmotionDetection]:
         """Analyze emotions in the text."""
-        self.logger.info("Analyzing emotions")
-        return self._call_api(self.prompts['emotion'], text)
+        self.logger.debug("Analyzing emotions")
+        return await self._call_api(self.prompts['emotion'], text, EmotionDetection)
 
-    def analyze_topics(self, text: str) -> Optional[Dict]:
+    async def analyze_topics(self, text: str) -> Optional[TopicAnalysis]:
         """Analyze topics in the text."""
-        self.logger.info("Analyzing topics")
-        return self._call_api(self.prompts['topic'], text)
+        self.logger.debug("Analyzing topics")
+        return await self._call_api(self.prompts['topic'], text, TopicAnalysis)
 
-    def calculate_adorescore(self, text: str, topic_result: Dict) -> Optional[Dict]:
+    async def calculate_adorescore(self, text: str,
+                                   topic_result: TopicAnalysis) -> Optional[AdorescoreAnalysis]:
         """Calculate adorescores using both text and topic information."""
-        self.logger.info("Calculating adorescores")
+        self.logger.debug("Calculating adorescores")
         
         # Combine the text and topic information for the API call
-        combined_input = json.dumps({
+        combined_input = msgspec.json.encode({
             "text": text,
             "topics": topic_result
         })
         
-        return self._call_api(self.prompts['adorescore'], combined_input)
+        return await self._call_api(self.prompts['adorescore'], combined_input,
+                                    AdorescoreAnalysis)
 
-    def generate_final_output(self, emotion_result: Dict, topic_result: Dict, 
-                            adorescore_result: Dict) -> Optional[Dict]:
-        """Combine results into final output format."""
-        self.logger.info("Generating final output")
-        
-        # Prepare combined results as a string
-        combined_input = json.dumps({
-            "emotion_analysis": emotion_result,
-            "topic_analysis": topic_result,
-            "adorescore_analysis": adorescore_result
-        })
-        
-        return self._call_api(self.prompts['output'], combined_input)
+    def generate_final_output(self, emotion_result: EmotionDetection,
+                              topic_result: TopicAnalysis,
+                              adorescore_result: AdorescoreAnalysis) -> AnalysisResult:
+        """Combine results into final output format.
 
-    def _read_input_file(self, file_path: str) -> Optional[str]:
-        """Read content from an input file."""
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                self.logger.info(f"Reading input file: {file_path}")
-                return f.read().strip()
-        except FileNotFoundError:
-            self.logger.error(f"File not found: {file_path}")
+        This is a plain field mapping, so it is done locally rather than
+        with another API call.
+        """
+        self.logger.debug("Generating final output")
+        return AnalysisResult(
+            emotions=Emotions(
+                primary=emotion_result.primary_emotion,
+                secondary=emotion_result.secondary_emotion
+            ),
+            topics=Topics(
+                main=topic_result.main_topics,
+                subtopics=topic_result.subtopics
+            ),
+            adorescore=Adorescore(
+                overall=adorescore_result.overall_adorescore,
+                breakdown={
+                    topic: topic_score.score
+                    for topic, topic_score in adorescore_result.topic_adorescores.items()
+                }
+            )
+        )
+
+    async def analyze_text(self, text: str) -> Optional[AnalysisResult]:
+        """Run all analyses in a single call using the combined prompt."""
+        self.logger.debug("Analyzing text with combined prompt")
+        return await self._call_api(self.prompts['combined'], text, AnalysisResult)
+
+    async def run_chain(self, text: str, name: str,
+                        on_step: Optional[Callable[[str], None]] = None) -> Optional[AnalysisResult]:
+        """Run the separate emotion, topic and adorescore calls.
+
+        ``on_step``, if given, is called with a short message after each
+        completed step of the chain.
+        """
+        # Emotion and topic analyses are independent, so run them together
+        emotion_result, topic_result = await asyncio.gather(
+            self.analyze_emotions(text), self.analyze_topics(text)
+        )
+        if not emotion_result:
+            self.logger.warning(f"Emotion analysis failed for {name}")
             return None
-        except Exception as e:
-            self.logger.error(f"Error reading file {file_path}: {e}")
+
+        if not topic_result:
+            self.logger.warning(f"Topic analysis failed for {name}")
+            return None
+
+        if on_step is not None:
+            on_step("Emotions and topics analyzed")
+
+        # Calculate adorescore using both text and topics
+        adorescore_result = await self.calculate_adorescore(text, topic_result)
+        if not adorescore_result:
+            self.logger.warning(f"Adorescore calculation failed for {name}")
             return None
 
-    def process_input_folder(self, input_folder: str, output_folder: str) -> None:
-        """Process all text files in the input folder and save results."""
-        input_path = Path(input_folder)
+        if on_step is not None:
+            on_step("Adorescore calculated")
+
+        # Generate final output
+        return self.generate_final_output(emotion_result, topic_result, adorescore_result)
+
+    async def _process_file(self, file_path: Path, text: str, output_path: Path,
+                            semaphore: asyncio.Semaphore, fused: bool) -> None:
+        """Analyze one file's text and save the result."""
+        async with semaphore:
+            self.logger.info(f"Processing file: {file_path.name}")
+
+            if fused:
+                final_result = await self.analyze_text(text)
+                if not final_result:
+                    self.logger.warning(f"Combined analysis failed for {file_path.name}")
+                    return
+            else:
+                final_result = await self.run_chain(
+                    text, file_path.name,
+                    lambda message: self.logger.debug(f"{file_path.name}: {message}")
+                )
+                if not final_result:
+                    return
+
+            # Save result as soon as it is ready
+            await save_result(final_result, output_path / f"{file_path.stem}.json", self.logger)
+
+    async def process_input_folder(self, input_folder: str, output_folder: str,
+                                   fused: bool = False) -> None:
+        """Process all text files in the input folder and save results.
+
+        With ``fused`` set, each file is analyzed with one combined call
+        instead of the separate prompt chain.
+        """
         output_path = Path(output_folder)
         output_path.mkdir(parents=True, exist_ok=True)
 
         self.logger.info(f"Processing input folder: {input_folder}")
         self.logger.info(f"Output folder: {output_folder}")
 
-        for file_path in input_path.glob("*.txt"):
-            self.logger.info(f"Processing file: {file_path.name}")
-            
-            # Read input text
-            text = self._read_input_file(str(file_path))
-            if not text:
-                self.logger.warning(f"Skipping {file_path.name} due to read error")
-                continue
-
-            # Perform separate analyses
-            emotion_result = self.analyze_emotions(text)
-            if not emotion_result:
-                self.logger.warning(f"Emotion analysis failed for {file_path.name}")
-                continue
-
-            topic_result = self.analyze_topics(text)
-            if not topic_result:
-                self.logger.warning(f"Topic analysis failed for {file_path.name}")
-                continue
-
-            # Calculate adorescore using both text and topics
-            adorescore_result = self.calculate_adorescore(text, topic_result)
-            if not adorescore_result:
-                self.logger.warning(f"Adorescore calculation failed for {file_path.name}")
-                continue
-
-            # Generate final output
-            final_result = self.generate_final_output(
-                emotion_result, topic_result, adorescore_result
-            )
-            if not final_result:
-                self.logger.warning(f"Final output generation failed for {file_path.name}")
-                continue
+        # Read all inputs up front so requests can be dispatched right away
+        inputs = await read_input_folder(input_folder, self.logger)
 
-            # Save result
-            output_file = output_path / f"{file_path.stem}.json"
-            try:
-                with open(output_file, "w", encoding="utf-8") as f:
-                    json.dump(final_result, f, indent=2)
-                self.logger.info(f"Analysis saved to {output_file}")
-            except Exception as e:
-                self.logger.error(f"Error saving results to {output_file}: {e}")
+        # Analyze all files concurrently, bounded by the semaphore
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+        tasks = [
+            self._process_file(file_path, text, output_path, semaphore, fused)
+            for file_path, text in inputs
+        ]
+        await asyncio.gather(*tasks)
 
 def main():
+    parser = argparse.ArgumentParser(description="Separate-prompt emotion analysis")
+    parser.add_argument(
+        "--fused", action="store_true",
+        help="analyze each file with one combined call instead of the prompt chain"
+    )
+    args = parser.parse_args()
+
     # Initialize the analyzer
     analyzer = SeparateEmotionAnalyzer()
 
@@ -204,7 +367,7 @@ def main():
     output_folder = "./SeparateApproach/output"
 
     # Process all files
-    analyzer.process_input_folder(input_folder, output_folder)
+    asyncio.run(analyzer.process_input_folder(input_folder, output_folder, fused=args.fused))
 
 if __name__ == "__main__":
     main()
@@ -1,51 +1,113 @@
 import os
-import json
+import msgspec
+import asyncio
 import logging
+import logging.handlers
+import httpx
+import itertools
 from pathlib import Path
-from typing import Dict, Optional
-from openai import OpenAI
+from typing import List, Optional, Tuple, Type, Union
+from openai import AsyncOpenAI
+from diskcache import Cache
 from dotenv import load_dotenv
 from datetime import datetime
+from common import (
+    AnalysisResult, ResultT, get_cached, prompt_hasher, read_input_folder,
+    read_prompt, save_result
+)
+
+# Upper bound on requests in flight, keeps us inside the Gemini RPM limit
+MAX_CONCURRENT_REQUESTS = 50
+
+# Number of feedback texts packed into a single batched request
+BATCH_SIZE = 8
+
+BATCH_PROMPT_SUFFIX = """
+
+Batch Input:
+
+The user message is a JSON array of objects, each with an "id" and a "text" field.
+Analyze every text independently, exactly as described above. Respond with a single
+JSON object of the form {"results": [...]}, containing one analysis object per input
+in the same order, each with the input's "id" added alongside the fields above."""
+
+# Log level used when LOG_LEVEL is not set in the environment
+DEFAULT_LOG_LEVEL = "WARNING"
+
+# One log file per process, named when the module is first imported
+LOG_TIMESTAMP = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+# Log records are buffered and written to file in blocks of this size
+LOG_BUFFER_CAPACITY = 1024
+
+# Connection pool shared by all requests from one analyzer
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+
+# Rate-limited, timed out and 5xx requests are retried this many times,
+# with exponential backoff that honors the Retry-After header
+MAX_RETRIES = 6
+
+# Cached API responses expire after a day
+CACHE_EXPIRE_SECONDS = 86400
+
+# Batch response schemas, validated when each response is decoded
+class BatchResponse(msgspec.Struct):
+    # Items are decoded one at a time so a single bad item does not fail the batch
+    results: List[msgspec.Raw] = []
+
+class BatchItemId(msgspec.Struct):
+    id: Union[int, str, None] = None
 
 class EmotionAnalyzer:
     def __init__(self):
         load_dotenv()
-        self.client = OpenAI(
+        self.client = AsyncOpenAI(
             api_key=os.getenv("GEMINI_API_KEY"),
-            base_url="https://generativelanguage.googleapis.com/v1beta/openai/"
+            base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
+            http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS),
+            max_retries=MAX_RETRIES
         )
         self.logger = self._setup_logger()
+        self.cache = Cache(Path(__file__).parent / ".llm_cache")
         self.system_prompt = self._load_system_prompt()
+        self.batch_prompt = self.system_prompt + BATCH_PROMPT_SUFFIX
 
     def _setup_logger(self) -> logging.Logger:
         """Setup logging configuration."""
+        # Create logger
+        logger = logging.getLogger("emotion_analyzer")
+
+        # Handlers are attached once per process, later analyzers reuse them
+        if logger.handlers:
+            return logger
+
         # Create logs directory
         log_dir = Path(__file__).parent / "logs"
         log_dir.mkdir(parents=True, exist_ok=True)
 
-        # Create a unique log file name with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        log_file = log_dir / f"emotion_analysis_{timestamp}.log"
+        # Use the per-process log file name
+        log_file = log_dir / f"emotion_analysis_{LOG_TIMESTAMP}.log"
 
-        # Create logger
-        logger = logging.getLogger("emotion_analyzer")
-        logger.setLevel(logging.INFO)
+        logger.setLevel(os.getenv("LOG_LEVEL", DEFAULT_LOG_LEVEL).upper())
 
         # Create file handler
         file_handler = logging.FileHandler(log_file)
-        file_handler.setLevel(logging.INFO)
 
         # Create console handler
         console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
 
         # Create formatter
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         file_handler.setFormatter(formatter)
         console_handler.setFormatter(formatter)
 
+        # Buffer file writes, flushing early only when an error is logged
+        buffered_handler = logging.handlers.MemoryHandler(
+            LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR, target=file_handler
+        )
+
         # Add handlers to logger
-        logger.addHandler(file_handler)
+        logger.addHandler(buffered_handler)
         logger.addHandler(console_handler)
 
         return logger
@@ -54,92 +116,177 @@ class EmotionAnalyzer:
         """Load the system prompt from the file."""
         prompt_path = Path(__file__).parent / "prompt" / "system_prompt.txt"
         try:
-            with open(prompt_path, "r", encoding="utf-8") as f:
-                self.logger.info(f"Loading system prompt from {prompt_path}")
-                return f.read()
+            self.logger.debug(f"Loading system prompt from {prompt_path}")
+            return read_prompt(prompt_path)
         except FileNotFoundError:
             self.logger.error(f"System prompt file not found at {prompt_path}")
             raise FileNotFoundError(f"System prompt file not found at {prompt_path}")
 
-    def _read_input_file(self, file_path: str) -> Optional[str]:
-        """Read content from an input file."""
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                self.logger.info(f"Reading input file: {file_path}")
-                return f.read().strip()
-        except FileNotFoundError:
-            self.logger.error(f"File not found: {file_path}")
-            return None
-        except Exception as e:
-            self.logger.error(f"Error reading file {file_path}: {e}")
-            return None
+    def _cache_key(self, prompt: str, text: str) -> str:
+        """Build the response cache key for a prompt and input text."""
+        hasher = prompt_hasher(prompt).copy()
+        hasher.update(text.encode("utf-8"))
+        return hasher.hexdigest()
 
-    def analyze_text(self, text: str) -> Optional[Dict]:
-        """Analyze text using the Gemini API."""
+    async def _call_api(self, prompt: str, text: str,
+                        schema: Type[ResultT]) -> Optional[ResultT]:
+        """Make an API call to Gemini and decode the response into ``schema``."""
         try:
-            self.logger.info("Sending request to Gemini API")
-            response = self.client.chat.completions.create(
+            self.logger.debug("Sending request to Gemini API")
+            response = await self.client.chat.completions.create(
                 model="gemini-2.0-flash",
                 n=1,
+                # Only the user message may vary between calls, keep the
+                # system prompt static so Gemini can reuse its cached prefix
                 messages=[
-                    {"role": "system", "content": self.system_prompt},
+                    {"role": "system", "content": prompt},
                     {"role": "user", "content": text}
-                ]
+                ],
+                # JSON mode returns bare JSON, without markdown code fences
+                response_format={"type": "json_object"}
             )
             
             # Extract the response content
             result = response.choices[0].message.content
-            self.logger.info("Received response from Gemini API")
-            
-            # Clean up the response by removing markdown code block markers
-            result = result.replace('```json', '').replace('```', '').strip()
+            self.logger.debug("Received response from Gemini API")
             
             # Parse the JSON response
             try:
-                parsed_result = json.loads(result)
-                self.logger.info("Successfully parsed JSON response")
+                parsed_result = msgspec.json.decode(result, type=schema)
+                self.logger.debug("Successfully parsed JSON response")
                 return parsed_result
-            except json.JSONDecodeError:
-                self.logger.error(f"Error parsing JSON response: {result}")
+            except msgspec.DecodeError as e:
+                self.logger.error(f"Error parsing JSON response ({e}): {result}")
                 return None
                 
         except Exception as e:
             self.logger.error(f"Error calling Gemini API: {e}")
             return None
 
-    def process_input_folder(self, input_folder: str, output_folder: str) -> None:
+    async def analyze_text(self, text: str) -> Optional[AnalysisResult]:
+        """Analyze text using the Gemini API."""
+        # Return the cached analysis if this text was seen before
+        key = self._cache_key(self.system_prompt, text)
+        cached = get_cached(self.cache, key, AnalysisResult, self.logger)
+        if cached is not None:
+            self.logger.debug("Using cached Gemini response")
+            return cached
+
+        parsed_result = await self._call_api(self.system_prompt, text, AnalysisResult)
+        if parsed_result is not None:
+            self.cache.set(key, msgspec.json.encode(parsed_result), expire=CACHE_EXPIRE_SECONDS)
+        return parsed_result
+
+    async def analyze_text_batch(self, texts: List[str]) -> List[Optional[AnalysisResult]]:
+        """Analyze several texts with a single Gemini API call.
+
+        Results are returned in input order. Any text the batch response does
+        not cover is retried on its own, so None only means that retry failed.
+        """
+        keys = [self._cache_key(self.system_prompt, text) for text in texts]
+        results = [get_cached(self.cache, key, AnalysisResult, self.logger) for key in keys]
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            self.logger.debug("Using cached Gemini responses for batch")
+            return results
+
+        # A batch of one gains nothing from the batch prompt
+        if len(pending) > 1:
+            batch_input = msgspec.json.encode(
+                [{"id": i, "text": texts[i]} for i in pending]
+            ).decode()
+            parsed_result = await self._call_api(self.batch_prompt, batch_input, BatchResponse)
+            if parsed_result is not None:
+                self._match_batch_results(parsed_result.results, pending, keys, results)
+
+        missing = [i for i in pending if results[i] is None]
+        if missing:
+            if len(pending) > 1:
+                self.logger.warning(f"Batch response missed {len(missing)} of {len(pending)} texts, retrying them individually")
+            retried = await asyncio.gather(*(self.analyze_text(texts[i]) for i in missing))
+            for index, result in zip(missing, retried):
+                results[index] = result
+
+        return results
+
+    def _match_batch_results(self, raw_items: List[msgspec.Raw], pending: List[int],
+                             keys: List[str], results: List[Optional[AnalysisResult]]) -> None:
+        """Fill ``results`` from a batch response.
+
+        Items are matched by id, as the model may reorder them, but only when
+        the returned ids are unique and cover exactly the texts that were sent;
+        only those matches are cached. Otherwise, if the model returned one
+        item per text, items are matched by position without being cached.
+        Anything left unmatched is retried on its own by the caller.
+        """
+        items = []
+        for raw_item in raw_items:
+            try:
+                item = msgspec.json.decode(raw_item, type=AnalysisResult)
+            except msgspec.DecodeError as e:
+                self.logger.error(f"Invalid item in batch response ({e}): {bytes(raw_item).decode()}")
+                item = None
+            try:
+                item_id = str(msgspec.json.decode(raw_item, type=BatchItemId).id)
+            except msgspec.DecodeError:
+                item_id = None
+            items.append((item_id, raw_item, item))
+
+        item_ids = [item_id for item_id, _, _ in items]
+        pending_ids = {str(i): i for i in pending}
+        if len(set(item_ids)) == len(item_ids) and set(item_ids) == pending_ids.keys():
+            for item_id, raw_item, item in items:
+                if item is None:
+                    continue
+                index = pending_ids[item_id]
+                results[index] = item
+                self.cache.set(keys[index], bytes(raw_item), expire=CACHE_EXPIRE_SECONDS)
+        elif len(items) == len(pending):
+            self.logger.warning("Batch response ids do not match the inputs, matching by position")
+            for index, (_, _, item) in zip(pending, items):
+                results[index] = item
+        else:
+            self.logger.warning("Batch response ids do not match the inputs, discarding it")
+
+    async def _process_batch(self, batch: List[Tuple[Path, str]], output_path: Path,
+                             semaphore: asyncio.Semaphore) -> None:
+        """Analyze a batch of files with one request and save each result."""
+        async with semaphore:
+            batch_paths = [file_path for file_path, _ in batch]
+            texts = [text for _, text in batch]
+            for file_path in batch_paths:
+                self.logger.info(f"Processing file: {file_path.name}")
+
+            # Analyze texts
+            results = await self.analyze_text_batch(texts)
+
+            # Save results as soon as the batch is back
+            writes = []
+            for file_path, result in zip(batch_paths, results):
+                if not result:
+                    self.logger.warning(f"Skipping {file_path.name} due to analysis error")
+                    continue
+                writes.append(save_result(result, output_path / f"{file_path.stem}.json", self.logger))
+            await asyncio.gather(*writes)
+
+    async def process_input_folder(self, input_folder: str, output_folder: str) -> None:
         """Process all text files in the input folder and save results."""
-        input_path = Path(input_folder)
         output_path = Path(output_folder)
         output_path.mkdir(parents=True, exist_ok=True)
 
         self.logger.info(f"Processing input folder: {input_folder}")
         self.logger.info(f"Output folder: {output_folder}")
 
-        # Process each .txt file in the input folder
-        for file_path in input_path.glob("*.txt"):
-            self.logger.info(f"Processing file: {file_path.name}")
-            
-            # Read input text
-            text = self._read_input_file(str(file_path))
-            if not text:
-                self.logger.warning(f"Skipping {file_path.name} due to read error")
-                continue
-
-            # Analyze text
-            result = self.analyze_text(text)
-            if not result:
-                self.logger.warning(f"Skipping {file_path.name} due to analysis error")
-                continue
-
-            # Save result
-            output_file = output_path / f"{file_path.stem}.json"
-            try:
-                with open(output_file, "w", encoding="utf-8") as f:
-                    json.dump(result, f, indent=2)
-                self.logger.info(f"Analysis saved to {output_file}")
-            except Exception as e:
-                self.logger.error(f"Error saving results to {output_file}: {e}")
+        # Read all inputs up front so requests can be dispatched right away
+        inputs = await read_input_folder(input_folder, self.logger)
+
+        # Group the texts into batches and send the batches concurrently
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        input_iter = iter(inputs)
+        tasks = []
+        while batch := list(itertools.islice(input_iter, BATCH_SIZE)):
+            tasks.append(self._process_batch(batch, output_path, semaphore))
+        await asyncio.gather(*tasks)
 
 def main():
     # Initialize the analyzer
@@ -150,7 +297,7 @@ def main():
     output_folder = "./SinglePromptApproach/output"
 
     # Process all files
-    analyzer.process_input_folder(input_folder, output_folder)
+    asyncio.run(analyzer.process_input_folder(input_folder, output_folder))
 
 if __name__ == "__main__":
     main() 
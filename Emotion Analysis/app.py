@@ -1,3 +1,7 @@
+import queue
+import asyncio
+import threading
+import msgspec
 import streamlit as st
 import plotly.graph_objects as go
 from SeparateApproach.main import SeparateEmotionAnalyzer
@@ -111,47 +115,48 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-def create_emotion_radar(emotions_data):
-    primary = emotions_data.get('primary', {})
-    secondary = emotions_data.get('secondary', {})
-    
-    fig = go.Figure()
-
-    fig.update_layout(
-        polar=dict(
-            radialaxis=dict(
-                visible=True,
-                range=[0, 1],
-                showline=False,
-                color='#666',
-                gridcolor='#333',
-                tickfont=dict(color='#666')
-            ),
-            angularaxis=dict(
-                color='#666',
-                gridcolor='#333'
-            ),
-            bgcolor='#262730'
+# Dark-theme radar layout, built once rather than on every rerun
+RADAR_LAYOUT = go.Layout(
+    polar=dict(
+        radialaxis=dict(
+            visible=True,
+            range=[0, 1],
+            showline=False,
+            color='#666',
+            gridcolor='#333',
+            tickfont=dict(color='#666')
         ),
-        paper_bgcolor='#262730',
-        plot_bgcolor='#262730',
-        font=dict(color='#FAFAFA'),
-        showlegend=True,
-        legend=dict(
-            yanchor="top",
-            y=0.99,
-            xanchor="left",
-            x=0.01,
-            bgcolor='rgba(0,0,0,0)',
-            font=dict(color='#FAFAFA')
+        angularaxis=dict(
+            color='#666',
+            gridcolor='#333'
         ),
-        margin=dict(l=40, r=40, t=40, b=40)
-    )
+        bgcolor='#262730'
+    ),
+    paper_bgcolor='#262730',
+    plot_bgcolor='#262730',
+    font=dict(color='#FAFAFA'),
+    showlegend=True,
+    legend=dict(
+        yanchor="top",
+        y=0.99,
+        xanchor="left",
+        x=0.01,
+        bgcolor='rgba(0,0,0,0)',
+        font=dict(color='#FAFAFA')
+    ),
+    margin=dict(l=40, r=40, t=40, b=40)
+)
+
+def create_emotion_radar(emotions_data):
+    primary = emotions_data.primary
+    secondary = emotions_data.secondary
+    
+    fig = go.Figure(layout=RADAR_LAYOUT)
     
     if primary:
         fig.add_trace(go.Scatterpolar(
-            r=[primary.get('intensity', 0)],
-            theta=[primary.get('emotion', '')],
+            r=[primary.intensity],
+            theta=[primary.emotion],
             fill='toself',
             name='Primary',
             fillcolor='rgba(255, 75, 75, 0.1)',
@@ -160,8 +165,8 @@ def create_emotion_radar(emotions_data):
     
     if secondary:
         fig.add_trace(go.Scatterpolar(
-            r=[secondary.get('intensity', 0)],
-            theta=[secondary.get('emotion', '')],
+            r=[secondary.intensity],
+            theta=[secondary.emotion],
             fill='toself',
             name='Secondary',
             fillcolor='rgba(54, 162, 235, 0.1)',
@@ -170,11 +175,83 @@ def create_emotion_radar(emotions_data):
     
     return fig
 
-# Initialize analyzers in session state
-if 'separate_analyzer' not in st.session_state:
-    st.session_state.separate_analyzer = SeparateEmotionAnalyzer()
-if 'single_analyzer' not in st.session_state:
-    st.session_state.single_analyzer = EmotionAnalyzer()
+# The analyzers hold async HTTP clients whose pooled connections are bound to
+# the event loop that opened them, so every rerun has to reuse the same loop
+# instead of spinning up a fresh one with asyncio.run().
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def run_async(coro, status=None, progress=None):
+    # The coroutine runs on the background loop while this script thread
+    # relays the step messages it puts on the progress queue to the status box
+    future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    if status is not None and progress is not None:
+        while not future.done():
+            try:
+                status.write(progress.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        while not progress.empty():
+            status.write(progress.get_nowait())
+    return future.result()
+
+# Analyzers are shared by every session in the process
+@st.cache_resource
+def get_separate_analyzer():
+    return SeparateEmotionAnalyzer()
+
+@st.cache_resource
+def get_single_analyzer():
+    return EmotionAnalyzer()
+
+def render_result(final_result, side_by_side=True):
+    if side_by_side:
+        # Create main content columns
+        chart_col, details_col = st.columns([2, 1])
+    else:
+        chart_col = details_col = st.container()
+    
+    with chart_col:
+        st.markdown('<div class="plot-container">', unsafe_allow_html=True)
+        fig = create_emotion_radar(final_result.emotions)
+        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
+        st.markdown('</div>', unsafe_allow_html=True)
+    
+    with details_col:
+        st.metric("Adorescore", f"+{final_result.adorescore.overall}")
+        
+        st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
+        
+        st.markdown("##### Analysis JSON")
+        st.markdown('<div class="json-viewer">', unsafe_allow_html=True)
+        st.json(msgspec.to_builtins(final_result))
+        st.markdown('</div>', unsafe_allow_html=True)
+        
+        if final_result.themes:
+            st.markdown("##### Top Themes")
+            for theme, score in final_result.themes.items():
+                st.markdown(
+                    f'<div class="theme-score">{theme}: {score}</div>',
+                    unsafe_allow_html=True
+                )
+
+async def run_single(analyzer, feedback, progress=None):
+    final_result = await analyzer.analyze_text(feedback)
+    if final_result and progress is not None:
+        progress.put("Single prompt analysis done")
+    return final_result
+
+async def run_both(single_analyzer, separate_analyzer, feedback, progress=None):
+    # Fire both approaches at once so a comparison takes as long as the slower one
+    return await asyncio.gather(
+        run_single(single_analyzer, feedback, progress),
+        separate_analyzer.run_chain(
+            feedback, "feedback", progress.put if progress is not None else None
+        )
+    )
 
 st.title("Emotion Analysis")
 
@@ -183,7 +260,7 @@ col1, col2, col3 = st.columns([1, 2, 1])
 with col2:
     approach = st.radio(
         "",
-        ["Single Prompt", "Separate Prompts"],
+        ["Single Prompt", "Separate Prompts", "Both"],
         horizontal=True,
         key="approach"
     )
@@ -193,62 +270,43 @@ with col2:
 
 if analyze_button and feedback:
     try:
-        with st.spinner("Analyzing feedback..."):
-            if approach == "Single Prompt":
-                analyzer = st.session_state.single_analyzer
-                final_result = analyzer.analyze_text(feedback)
+        progress = queue.Queue()
+        with st.status("Analyzing feedback...", expanded=True) as status:
+            if approach == "Both":
+                results = run_async(run_both(
+                    get_single_analyzer(), get_separate_analyzer(), feedback, progress
+                ), status, progress)
+            elif approach == "Single Prompt":
+                analyzer = get_single_analyzer()
+                results = [run_async(run_single(analyzer, feedback, progress), status, progress)]
             else:
-                analyzer = st.session_state.separate_analyzer
-                emotion_result = analyzer.analyze_emotions(feedback)
-                if emotion_result:
-                    topic_result = analyzer.analyze_topics(feedback)
-                    if topic_result:
-                        adorescore_result = analyzer.calculate_adorescore(feedback, topic_result)
-                        if adorescore_result:
-                            final_result = analyzer.generate_final_output(
-                                emotion_result, topic_result, adorescore_result
-                            )
-                        else:
-                            final_result = None
-                    else:
-                        final_result = None
-                else:
-                    final_result = None
+                analyzer = get_separate_analyzer()
+                results = [run_async(analyzer.run_chain(feedback, "feedback", progress.put), status, progress)]
             
-            if final_result:
-                st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
-                
-                # Create main content columns
-                col1, col2 = st.columns([2, 1])
-                
-                with col1:
-                    st.markdown('<div class="plot-container">', unsafe_allow_html=True)
-                    if 'emotions' in final_result:
-                        fig = create_emotion_radar(final_result['emotions'])
-                        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': False})
-                    st.markdown('</div>', unsafe_allow_html=True)
-                
-                with col2:
-                    if 'adorescore' in final_result:
-                        st.metric("Adorescore", f"+{final_result['adorescore']['overall']}")
-                    
-                    st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
-                    
-                    st.markdown("##### Analysis JSON")
-                    st.markdown('<div class="json-viewer">', unsafe_allow_html=True)
-                    st.json(final_result)
-                    st.markdown('</div>', unsafe_allow_html=True)
-                    
-                    if 'themes' in final_result:
-                        st.markdown("##### Top Themes")
-                        for theme, score in final_result['themes'].items():
-                            st.markdown(
-                                f'<div class="theme-score">{theme}: {score}</div>',
-                                unsafe_allow_html=True
-                            )
+            if all(results):
+                status.update(label="Analysis complete", state="complete", expanded=False)
             else:
-                st.error("Failed to generate analysis")
+                status.update(label="Analysis failed", state="error", expanded=False)
+        
+        if approach == "Both":
+            st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
+            
+            single_col, separate_col = st.columns(2)
+            for column, title, final_result in zip(
+                [single_col, separate_col], ["Single Prompt", "Separate Prompts"], results
+            ):
+                with column:
+                    st.markdown(f"#### {title}")
+                    if final_result:
+                        render_result(final_result, side_by_side=False)
+                    else:
+                        st.error("Failed to generate analysis")
+        elif results[0]:
+            st.markdown('<div class="divider"></div>', unsafe_allow_html=True)
+            render_result(results[0])
+        else:
+            st.error("Failed to generate analysis")
     except Exception as e:
         st.error(f"An error occurred during analysis: {str(e)}")
 elif analyze_button:
-    st.warning("Please enter some feedback to analyze.") 
+    st.warning("Please enter some feedback to analyze.")
@@ -0,0 +1,129 @@
+import os
+import msgspec
+import hashlib
+import functools
+import asyncio
+import logging
+import aiofiles
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Type, TypeVar, Union
+from diskcache import Cache
+
+# Final analysis schema, shared by both approaches and rendered by the app
+Score = Union[int, float]
+
+class Emotion(msgspec.Struct):
+    emotion: str
+    intensity: Score = 0.0
+    activation: str = ""
+
+class Emotions(msgspec.Struct, omit_defaults=True):
+    primary: Emotion
+    secondary: Optional[Emotion] = None
+
+class Topics(msgspec.Struct):
+    main: List[str] = []
+    subtopics: Dict[str, List[str]] = {}
+
+class Adorescore(msgspec.Struct):
+    overall: Score
+    breakdown: Dict[str, Score] = {}
+
+class AnalysisResult(msgspec.Struct, omit_defaults=True):
+    """Final analysis in the format rendered by the app."""
+    emotions: Emotions
+    topics: Topics
+    adorescore: Adorescore
+    themes: Dict[str, Score] = {}
+
+ResultT = TypeVar("ResultT", bound=msgspec.Struct)
+
+@functools.lru_cache(maxsize=None)
+def read_prompt(path: Path) -> str:
+    """Read a prompt template, caching it for the life of the process.
+
+    Templates are stripped once here so the system message sent to Gemini is
+    byte-identical on every call, which lets its implicit prefix cache hit.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+@functools.lru_cache(maxsize=None)
+def prompt_hasher(prompt: str) -> "hashlib.blake2b":
+    """Return a cache-key hasher already fed with the encoded prompt.
+
+    Prompts are long and static, so they are UTF-8 encoded and hashed once;
+    each key then only has to hash the input text on a copy of this state.
+    """
+    return hashlib.blake2b(prompt.encode("utf-8") + b"\x00", digest_size=16)
+
+def get_cached(cache: Cache, key: str, schema: Type[ResultT],
+               logger: logging.Logger) -> Optional[ResultT]:
+    """Return the cached response for ``key`` decoded as ``schema``.
+
+    The cache holds the raw response JSON rather than pickled Structs, so
+    entries stay valid whichever module the schema was imported from. Any
+    unreadable or stale entry is treated as a miss.
+    """
+    try:
+        cached = cache.get(key)
+        if cached is None:
+            return None
+        return msgspec.json.decode(cached, type=schema)
+    except Exception as e:
+        logger.debug(f"Ignoring unusable cache entry: {e}")
+        return None
+
+def read_input_file(file_path: str, logger: logging.Logger) -> Optional[str]:
+    """Read content from an input file."""
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            logger.debug(f"Reading input file: {file_path}")
+            return f.read().strip()
+    except FileNotFoundError:
+        logger.error(f"File not found: {file_path}")
+        return None
+    except Exception as e:
+        logger.error(f"Error reading file {file_path}: {e}")
+        return None
+
+async def read_input_folder(input_folder: str,
+                            logger: logging.Logger) -> List[Tuple[Path, str]]:
+    """Read every .txt file in the input folder concurrently."""
+    # scandir entries carry the file type, so filtering needs no extra stat
+    try:
+        with os.scandir(input_folder) as entries:
+            file_paths = [
+                Path(entry.path) for entry in entries
+                if entry.name.endswith(".txt") and entry.is_file()
+            ]
+    except FileNotFoundError:
+        logger.error(f"Input folder not found: {input_folder}")
+        return []
+    except OSError as e:
+        logger.error(f"Error reading input folder {input_folder}: {e}")
+        return []
+
+    # Each read runs in a worker thread so the reads overlap
+    texts = await asyncio.gather(*(
+        asyncio.to_thread(read_input_file, str(file_path), logger)
+        for file_path in file_paths
+    ))
+
+    inputs = []
+    for file_path, text in zip(file_paths, texts):
+        if not text:
+            logger.warning(f"Skipping {file_path.name} due to read error")
+            continue
+        inputs.append((file_path, text))
+    return inputs
+
+async def save_result(result: AnalysisResult, output_file: Path,
+                      logger: logging.Logger) -> None:
+    """Write an analysis result to disk without blocking the event loop."""
+    try:
+        async with aiofiles.open(output_file, "wb") as f:
+            await f.write(msgspec.json.format(msgspec.json.encode(result), indent=2))
+        logger.info(f"Analysis saved to {output_file}")
+    except Exception as e:
+        logger.error(f"Error saving results to {output_file}: {e}")